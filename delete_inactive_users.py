@@ -1,23 +1,41 @@
 #!/usr/bin/env python3
 """
 Script to identify and delete inactive Port users with no activity in the last 30 days.
-Backs up user data before deletion and creates a timestamped zip archive.
+Backs up the data of deleted users to a timestamped zip archive.
 
 IMPORTANT NOTE: When a user is deleted, entities they created remain in Port.
 They are not automatically deleted. If you need to clean up entities created by
 deleted users, you'll need to handle that separately.
 """
 
+import asyncio
+import httpx
 import requests
 import json
+import logging
 import os
+import re
+import tempfile
+import time
 import zipfile
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator, Optional
+from itertools import islice
 import sys
 from dotenv import load_dotenv
 from pathlib import Path
 from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson parses and serializes much faster than the stdlib json module; fall back to json if it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Per-user progress goes through logging so it can be filtered or redirected
+logger = logging.getLogger(__name__)
 
 # Determine if .env file exists and load it
 env_path = Path('.env')
@@ -37,28 +55,111 @@ dotenv_loaded = load_dotenv()
 PORT_API_BASE_URL = os.getenv('PORT_API_URL', 'https://api.getport.io')
 PORT_CLIENT_ID = os.getenv('PORT_CLIENT_ID', '')
 PORT_CLIENT_SECRET = os.getenv('PORT_CLIENT_SECRET', '')
+PORT_DEBUG = os.getenv('PORT_DEBUG', '').strip().lower() in ('1', 'true', 'yes')  # Show the credential source debug banner
 
 # Headers for API requests
 HEADERS = {
     'Content-Type': 'application/json'
 }
 
+# Shared HTTP session so all synchronous API calls reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        raise_on_status=False  # Hand the final response back so our error handling can report it
+    )
+)
+SESSION.mount('https://', adapter)
+SESSION.mount('http://', adapter)
+
 # Constants
 BLUEPRINT_IDENTIFIER = '_user'
 INACTIVE_STATUS_VALUES = ['inactive', 'Inactive', 'INACTIVE', 'Disabled', 'disabled', 'DISABLED']
+INACTIVE_SET = frozenset(s.lower() for s in INACTIVE_STATUS_VALUES)
 DAYS_THRESHOLD = 30
-BACKUP_DIR = 'user_backups'
+DELETE_CONCURRENCY = 20  # Maximum number of DELETE requests in flight at once
+BULK_DELETE_CHUNK_SIZE = 100  # Maximum number of users per bulk delete request
+BULK_DELETE_RESPONSE_KEYS = frozenset({'ok', 'errors', 'entities'})  # Fields a confirmed bulk delete response may contain
+SEARCH_PAGE_SIZE = 1000  # Maximum number of users returned per search request
+COMPRESS_LEVEL = 1  # Deflate level for the backup archive (1 = fastest, 9 = smallest)
+ARCHIVE_MANIFEST_NAME = '_manifest.json'  # Records which archived users were actually deleted
+TOKEN_CACHE_FILE = Path.home() / '.cache' / 'port' / 'token.json'
+TOKEN_EXPIRY_MARGIN = 60  # Re-authenticate when the cached token expires within this many seconds
+
+
+def load_cached_token() -> Optional[str]:
+    """
+    Return the cached access token if it belongs to the current client and API URL
+    and is not about to expire. Returns None otherwise.
+    """
+    try:
+        with open(TOKEN_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if cached.get('clientId') != PORT_CLIENT_ID or cached.get('apiUrl') != PORT_API_BASE_URL:
+        return None
+    if cached.get('exp', 0) - time.time() <= TOKEN_EXPIRY_MARGIN:
+        return None
+    return cached.get('token')
+
+
+def save_cached_token(access_token: str, expires_in: float) -> None:
+    """
+    Atomically write the access token and its expiry time to the cache file.
+    The file is only readable by the current user.
+    """
+    TOKEN_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    cached = {
+        'token': access_token,
+        'exp': time.time() + expires_in,
+        'clientId': PORT_CLIENT_ID,
+        'apiUrl': PORT_API_BASE_URL
+    }
+    
+    # mkstemp creates the file with 0600 permissions
+    fd, tmp_path = tempfile.mkstemp(dir=TOKEN_CACHE_FILE.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, TOKEN_CACHE_FILE)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
-def get_port_access_token() -> str:
+def clear_cached_token() -> None:
+    """
+    Remove the cached access token, if any.
+    """
+    try:
+        os.remove(TOKEN_CACHE_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def get_port_access_token(use_cache: bool = True) -> str:
     """
     Get Port API access token using client credentials.
+    Reuses a cached token from a previous run unless use_cache is False.
     """
     if not PORT_CLIENT_ID or not PORT_CLIENT_SECRET:
         raise ValueError(
             "PORT_CLIENT_ID and PORT_CLIENT_SECRET must be set as environment variables"
         )
     
+    if use_cache:
+        cached_token = load_cached_token()
+        if cached_token:
+            return cached_token
+    
     # Port API uses /v1/auth/access_token endpoint
     auth_url = f"{PORT_API_BASE_URL}/v1/auth/access_token"
     payload = {
@@ -67,7 +168,7 @@ def get_port_access_token() -> str:
     }
     
     try:
-        response = requests.post(auth_url, json=payload, headers=HEADERS)
+        response = SESSION.post(auth_url, json=payload)
         
         # Better error handling for 401
         if response.status_code == 401:
@@ -84,6 +185,13 @@ def get_port_access_token() -> str:
         if not access_token:
             raise ValueError(f"Unexpected response format from auth endpoint: {data}")
         
+        expires_in = data.get('expiresIn') or data.get('expires_in')
+        if expires_in:
+            try:
+                save_cached_token(access_token, float(expires_in))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not cache access token: {e}")
+        
         return access_token
     except requests.exceptions.RequestException as e:
         if hasattr(e, 'response') and e.response is not None:
@@ -94,61 +202,100 @@ def get_port_access_token() -> str:
         raise
 
 
-def get_all_users(access_token: str) -> List[Dict]:
+def set_session_token(access_token: str) -> None:
     """
-    Fetch all users from Port using GET entities API.
-    Endpoint: GET /v1/blueprints/{blueprint_identifier}/entities
+    Attach the access token to SESSION so every subsequent request reuses the
+    same Authorization header instead of building one per call.
     """
-    # Correct endpoint format: /v1/blueprints/{blueprint_identifier}/entities
-    url = f"{PORT_API_BASE_URL}/v1/blueprints/{BLUEPRINT_IDENTIFIER}/entities"
-    headers = {
-        **HEADERS,
-        'Authorization': f'Bearer {access_token}'
-    }
+    SESSION.headers['Authorization'] = f'Bearer {access_token}'
+
+
+def port_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Send a request through SESSION. If Port rejects the token with a 401 (e.g. a
+    cached token was revoked), drop the cache, re-authenticate and retry once.
+    If re-authentication fails, the original 401 response is returned so callers
+    handle it like any other HTTP error.
+    """
+    response = SESSION.request(method, url, **kwargs)
+    if response.status_code != 401:
+        return response
     
-    # Try without query parameters first - Port API may return all entities
-    # or may not support pagination via query params for this endpoint
+    clear_cached_token()
     try:
-        response = requests.get(
-            url,
-            headers=headers
-        )
-        
-        # Better error handling
-        if response.status_code == 422:
-            error_data = {}
-            try:
-                error_data = response.json()
-            except (ValueError, json.JSONDecodeError):
-                pass
+        set_session_token(get_port_access_token(use_cache=False))
+    except (ValueError, requests.exceptions.RequestException) as e:
+        logger.error(f"Re-authentication after 401 failed: {e}")
+        return response
+    return SESSION.request(method, url, **kwargs)
+
+
+def get_inactive_users() -> List[Dict]:
+    """
+    Fetch users with an inactive status from Port, filtered server-side.
+    Port's 'in' operator matches properties.status exactly (case-sensitive), so only
+    the spellings listed in INACTIVE_STATUS_VALUES are found.
+    Endpoint: POST /v1/blueprints/{blueprint_identifier}/entities/search
+    Follows the `next` cursor until every page has been fetched.
+    Requires SESSION to already carry the Authorization header.
+    """
+    url = f"{PORT_API_BASE_URL}/v1/blueprints/{BLUEPRINT_IDENTIFIER}/entities/search"
+    # Calculated properties are kept so the archived backups hold the full entity
+    params = {
+        'attach_title_to_relation': 'false'
+    }
+    payload = {
+        "query": {
+            "combinator": "and",
+            "rules": [
+                {"property": "status", "operator": "in", "value": INACTIVE_STATUS_VALUES}
+            ]
+        },
+        "limit": SEARCH_PAGE_SIZE
+    }
+    
+    users = []
+    while True:
+        try:
+            response = port_request('POST', url, params=params, json=payload)
             
-            error_msg = "422 Unprocessable Entity - Invalid request format\n"
-            error_msg += f"Request URL: {response.url}\n"
-            error_msg += f"Response status: {response.status_code}\n"
-            error_msg += f"Response body: {response.text}"
-            if error_data:
-                error_msg += f"\nParsed error: {json.dumps(error_data, indent=2)}"
-            raise ValueError(error_msg)
+            # Better error handling
+            if response.status_code == 422:
+                error_data = {}
+                try:
+                    error_data = response.json()
+                except (ValueError, json.JSONDecodeError):
+                    pass
+                
+                error_msg = "422 Unprocessable Entity - Invalid request format\n"
+                error_msg += f"Request URL: {response.url}\n"
+                error_msg += f"Response status: {response.status_code}\n"
+                error_msg += f"Response body: {response.text}"
+                if error_data:
+                    error_msg += f"\nParsed error: {json.dumps(error_data, indent=2)}"
+                raise ValueError(error_msg)
+            
+            response.raise_for_status()
+            
+        except requests.exceptions.HTTPError as e:
+            if hasattr(e, 'response') and e.response is not None:
+                error_msg = f"Error fetching users: {e}\n"
+                error_msg += f"Status Code: {e.response.status_code}\n"
+                error_msg += f"Response: {e.response.text}\n"
+                if hasattr(e.response, 'url'):
+                    error_msg += f"Request URL: {e.response.url}"
+                raise ValueError(error_msg) from e
+            raise
         
-        response.raise_for_status()
+        # Parse the raw bytes with orjson when available; pages can be several MB
+        data = orjson.loads(response.content) if orjson is not None else response.json()
+        users.extend(data.get('entities', []))
         
-    except requests.exceptions.HTTPError as e:
-        if hasattr(e, 'response') and e.response is not None:
-            error_msg = f"Error fetching users: {e}\n"
-            error_msg += f"Status Code: {e.response.status_code}\n"
-            error_msg += f"Response: {e.response.text}\n"
-            if hasattr(e.response, 'url'):
-                error_msg += f"Request URL: {e.response.url}"
-            raise ValueError(error_msg) from e
-        raise
-    
-    data = response.json()
-    # Handle different possible response structures
-    users = data.get('entities', [])
-    if not users and isinstance(data, list):
-        users = data
-    
-    return users
+        # Pages are cursor-based, so each request depends on the previous response
+        next_cursor = data.get('next')
+        if not next_cursor:
+            return users
+        payload['from'] = next_cursor
 
 
 def is_inactive(user: Dict) -> bool:
@@ -158,13 +305,12 @@ def is_inactive(user: Dict) -> bool:
     # Check in properties first, then at root level
     status = user.get('properties', {}).get('status', '') or user.get('status', '')
     # Normalize status for comparison
-    status_lower = str(status).lower() if status else ''
-    return status_lower in [s.lower() for s in INACTIVE_STATUS_VALUES]
+    return str(status).lower() in INACTIVE_SET
 
 
-def has_recent_activity(user: Dict, days_threshold: int = DAYS_THRESHOLD) -> bool:
+def has_recent_activity(user: Dict, threshold_date: datetime) -> bool:
     """
-    Check if user has had any activity (updates) in the last N days.
+    Check if user has had any activity (updates) since threshold_date.
     Returns True if updated within threshold, False otherwise.
     """
     updated_at = user.get('updatedAt')
@@ -177,136 +323,243 @@ def has_recent_activity(user: Dict, days_threshold: int = DAYS_THRESHOLD) -> boo
     
     try:
         # Parse ISO 8601 datetime
-        if 'T' in updated_at:
-            # Remove timezone info if present for parsing
-            updated_at_clean = updated_at.split('+')[0].split('Z')[0]
-            if '.' in updated_at_clean:
-                updated_at_clean = updated_at_clean.split('.')[0]
-            last_update = datetime.strptime(updated_at_clean, '%Y-%m-%dT%H:%M:%S')
-        else:
-            last_update = datetime.strptime(updated_at, '%Y-%m-%d')
+        iso_value = updated_at.replace('Z', '+00:00')
+        try:
+            last_update = datetime.fromisoformat(iso_value)
+        except ValueError:
+            # Before Python 3.11 fromisoformat rejects fractional seconds that aren't
+            # 3 or 6 digits long, so retry without them, keeping any UTC offset
+            last_update = datetime.fromisoformat(re.sub(r'\.\d+', '', iso_value))
+        if last_update.tzinfo is not None:
+            # Convert to naive local time so it compares with threshold_date
+            last_update = last_update.astimezone().replace(tzinfo=None)
         
-        threshold_date = datetime.now() - timedelta(days=days_threshold)
         return last_update >= threshold_date
     except Exception as e:
-        print(f"Warning: Could not parse date '{updated_at}' for user {user.get('identifier')}: {e}")
+        logger.warning(f"Could not parse date '{updated_at}' for user {user.get('identifier')}: {e}")
         # If we can't parse the date, assume no recent activity to be safe
         return False
 
 
-def backup_user(user: Dict, backup_dir: str) -> str:
+def chunked(items: Iterable, size: int) -> Iterator[List]:
     """
-    Backup user entity to a JSON file.
-    Returns the path to the backup file.
+    Split an iterable into lists of at most `size` items.
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def add_user_to_archive(zipf: zipfile.ZipFile, user: Dict) -> None:
+    """
+    Write a user entity as JSON straight into the backup archive.
+    Called before the user is deleted.
     """
     user_id = user.get('identifier', 'unknown')
-    backup_file = os.path.join(backup_dir, f'{user_id}.json')
-    
-    with open(backup_file, 'w', encoding='utf-8') as f:
-        json.dump(user, f, indent=2, ensure_ascii=False)
-    
-    return backup_file
+    if orjson is not None:
+        data = orjson.dumps(user, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(user, indent=2, ensure_ascii=False).encode('utf-8')
+    zipf.writestr(f'{user_id}.json', data)
 
 
-def delete_user(access_token: str, user_identifier: str) -> bool:
+def add_manifest_to_archive(zipf: zipfile.ZipFile, deleted: List[str], not_deleted: List[str]) -> None:
     """
-    Delete a user from Port.
-    Endpoint: DELETE /v1/blueprints/{blueprint_identifier}/entities/{entity_identifier}
-    Returns True if successful, False otherwise.
+    Write a manifest recording which archived users were deleted and which were not.
+    Users archived but listed in neither (e.g. the run was interrupted mid-chunk)
+    may or may not have been deleted.
     """
-    # URL encode the identifier to handle special characters like +, @, etc.
-    encoded_identifier = quote(user_identifier, safe='')
-    url = f"{PORT_API_BASE_URL}/v1/blueprints/{BLUEPRINT_IDENTIFIER}/entities/{encoded_identifier}"
-    headers = {
-        **HEADERS,
-        'Authorization': f'Bearer {access_token}'
+    manifest = {
+        'deleted': deleted,
+        'notDeleted': not_deleted
+    }
+    zipf.writestr(ARCHIVE_MANIFEST_NAME, json.dumps(manifest, indent=2, ensure_ascii=False).encode('utf-8'))
+
+
+def get_bulk_delete_failures(data, user_identifiers: List[str]) -> Optional[set]:
+    """
+    Collect the identifiers a bulk delete response reports as not deleted.
+    Errors may reference an entity by identifier or by its index in the request.
+    Returns None if the response can't be trusted to confirm the batch: it is not
+    an ok response of a known shape, or it reports an error that can't be matched
+    to a user. Every user should then be treated as not deleted.
+    """
+    if not isinstance(data, dict) or data.get('ok') is not True:
+        return None
+    # Any unknown field (e.g. a differently named failure list) might report failures
+    if not set(data) <= BULK_DELETE_RESPONSE_KEYS:
+        return None
+    
+    errors = data.get('errors') or []
+    if not isinstance(errors, list):
+        return None
+    
+    failed = set()
+    for error in errors:
+        if isinstance(error, str) and error in user_identifiers:
+            failed.add(error)
+        elif isinstance(error, dict) and error.get('identifier') in user_identifiers:
+            failed.add(error['identifier'])
+        elif (isinstance(error, dict) and type(error.get('index')) is int
+              and 0 <= error['index'] < len(user_identifiers)):
+            failed.add(user_identifiers[error['index']])
+        else:
+            return None
+    return failed
+
+
+def delete_users_bulk(user_identifiers: List[str]) -> Optional[List[bool]]:
+    """
+    Delete a batch of users from Port in a single request.
+    Endpoint: DELETE /v1/blueprints/{blueprint_identifier}/bulk/entities
+    Returns one result per identifier, in the same order: False if Port reported
+    an error for that user, True otherwise. Returns None if the request failed or
+    its response didn't confirm the batch. Callers should retry any user that
+    wasn't deleted individually.
+    """
+    url = f"{PORT_API_BASE_URL}/v1/blueprints/{BLUEPRINT_IDENTIFIER}/bulk/entities"
+    payload = {
+        "entities": user_identifiers
     }
     
     try:
-        response = requests.delete(url, headers=headers)
+        response = port_request('DELETE', url, json=payload)
         response.raise_for_status()
-        return True
     except requests.exceptions.RequestException as e:
-        print(f"Error deleting user {user_identifier}: {e}")
+        logger.error(f"Bulk delete of {len(user_identifiers)} user(s) failed: {e}")
         if hasattr(e, 'response') and e.response is not None:
-            print(f"Response: {e.response.text}")
-            print(f"Request URL: {url}")
-        return False
+            logger.error(f"Response: {e.response.text}")
+            logger.error(f"Request URL: {url}")
+        return None
+    
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    
+    failed = get_bulk_delete_failures(data, user_identifiers)
+    if failed is None:
+        logger.error(f"Bulk delete of {len(user_identifiers)} user(s) returned an unrecognised response: {response.text}")
+        return None
+    return [user_identifier not in failed for user_identifier in user_identifiers]
 
 
-def create_zip_archive(backup_dir: str, zip_filename: str) -> None:
+async def delete_user_async(client: httpx.AsyncClient, user_identifier: str) -> bool:
     """
-    Create a zip archive of all backup files.
+    Delete a user from Port using a shared HTTP/2 client.
+    Endpoint: DELETE /v1/blueprints/{blueprint_identifier}/entities/{entity_identifier}
+    Returns True if successful or the user no longer exists, False otherwise.
     """
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(backup_dir):
-            for file in files:
-                if file.endswith('.json'):
-                    file_path = os.path.join(root, file)
-                    zipf.write(file_path, arcname=file)
+    # URL encode the identifier to handle special characters like +, @, etc.
+    encoded_identifier = quote(user_identifier, safe='')
+    path = f"/v1/blueprints/{BLUEPRINT_IDENTIFIER}/entities/{encoded_identifier}"
     
-    print(f"\nBackup archive created: {zip_filename}")
+    try:
+        response = await client.delete(path)
+        # A partially applied bulk delete (or a retried DELETE) may already have removed the user
+        if response.status_code == 404:
+            logger.info(f"User {user_identifier} was already deleted")
+            return True
+        response.raise_for_status()
+        return True
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Error deleting user {user_identifier}: {e}")
+        logger.error(f"Response: {e.response.text}")
+        logger.error(f"Request URL: {e.request.url}")
+        return False
+    except httpx.HTTPError as e:
+        logger.error(f"Error deleting user {user_identifier}: {e}")
+        return False
 
 
-def cleanup_backup_dir(backup_dir: str) -> None:
+async def delete_users_concurrently(user_identifiers: List[str],
+                                    concurrency: int = DELETE_CONCURRENCY) -> List:
     """
-    Remove backup directory and its contents.
+    Delete users from Port concurrently, with at most `concurrency` requests in flight.
+    Requests are multiplexed as HTTP/2 streams over as few connections as possible.
+    Uses the Authorization header currently set on SESSION, so a token refreshed by
+    port_request is picked up.
+    Returns one result per identifier, in the same order: True/False as returned by
+    delete_user_async, or the exception raised while deleting that user.
     """
-    if os.path.exists(backup_dir):
-        for file in os.listdir(backup_dir):
-            os.remove(os.path.join(backup_dir, file))
-        os.rmdir(backup_dir)
+    headers = {
+        **HEADERS,
+        'Authorization': SESSION.headers['Authorization']
+    }
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async with httpx.AsyncClient(
+        http2=True,
+        base_url=PORT_API_BASE_URL,
+        headers=headers,
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    ) as client:
+        async def bounded_delete(user_identifier: str) -> bool:
+            async with semaphore:
+                return await delete_user_async(client, user_identifier)
+        
+        return await asyncio.gather(
+            *(bounded_delete(user_identifier) for user_identifier in user_identifiers),
+            return_exceptions=True
+        )
 
 
 def main():
     """
     Main execution function.
     """
+    # Send log records to stdout with no prefix so they read like the rest of the output
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    
     print("Starting inactive user cleanup process...")
     print(f"Looking for users with inactive status and no activity in the last {DAYS_THRESHOLD} days\n")
     
-    # Debug: Show credential source information
-    print("="*60)
-    print("CREDENTIAL SOURCE DEBUG")
-    print("="*60)
-    
-    env_file_path = Path('.env').absolute()
-    env_exists = env_file_path.exists()
-    
-    print(f".env file exists: {env_exists}")
-    if env_exists:
-        print(f".env file path: {env_file_path}")
-        print(f".env file readable: {os.access(env_file_path, os.R_OK)}")
-    else:
-        print(f".env file path (not found): {env_file_path}")
-    
-    # Check if variables were set before load_dotenv()
-    had_env_vars_before = bool(client_id_from_env and client_secret_from_env)
-    print(f"Environment variables set before load_dotenv(): {had_env_vars_before}")
-    
-    # Check current state
-    has_credentials = bool(PORT_CLIENT_ID and PORT_CLIENT_SECRET)
-    print(f"Credentials loaded: {has_credentials}")
-    
-    if has_credentials:
-        # Try to determine source by checking if .env was loaded
-        if env_exists and not had_env_vars_before:
-            print("Source: .env file (credentials were NOT in environment before)")
-        elif had_env_vars_before:
-            print("Source: Environment variables (from .zshrc or shell)")
-            if env_exists:
-                print("  ⚠️  WARNING: .env file exists but load_dotenv() does NOT override")
-                print("     existing environment variables by default.")
-                print("     Your .zshrc values are being used, not .env file values!")
-                print("     To use .env file, either:")
-                print("     1. Unset variables: unset PORT_CLIENT_ID PORT_CLIENT_SECRET")
-                print("     2. Or modify script to use: load_dotenv(override=True)")
+    # Debug: Show credential source information (set PORT_DEBUG=1 to enable)
+    if PORT_DEBUG:
+        print("="*60)
+        print("CREDENTIAL SOURCE DEBUG")
+        print("="*60)
+        
+        env_file_path = env_path.absolute()
+        
+        print(f".env file exists: {env_file_exists}")
+        if env_file_exists:
+            print(f".env file path: {env_file_path}")
+            print(f".env file readable: {os.access(env_file_path, os.R_OK)}")
         else:
-            print("Source: Unknown (check manually)")
-    
-    print("="*60)
-    print()
-    
+            print(f".env file path (not found): {env_file_path}")
+        
+        # Check if variables were set before load_dotenv()
+        had_env_vars_before = bool(client_id_from_env and client_secret_from_env)
+        print(f"Environment variables set before load_dotenv(): {had_env_vars_before}")
+        
+        # Check current state
+        has_credentials = bool(PORT_CLIENT_ID and PORT_CLIENT_SECRET)
+        print(f"Credentials loaded: {has_credentials}")
+        
+        if has_credentials:
+            # Try to determine source by checking if .env was loaded
+            if env_file_exists and not had_env_vars_before:
+                print("Source: .env file (credentials were NOT in environment before)")
+            elif had_env_vars_before:
+                print("Source: Environment variables (from .zshrc or shell)")
+                if env_file_exists:
+                    print("  ⚠️  WARNING: .env file exists but load_dotenv() does NOT override")
+                    print("     existing environment variables by default.")
+                    print("     Your .zshrc values are being used, not .env file values!")
+                    print("     To use .env file, either:")
+                    print("     1. Unset variables: unset PORT_CLIENT_ID PORT_CLIENT_SECRET")
+                    print("     2. Or modify script to use: load_dotenv(override=True)")
+            else:
+                print("Source: Unknown (check manually)")
+        
+        print("="*60)
+        print()
+        
     # Debug: Check if credentials are loaded (without showing values)
     if not PORT_CLIENT_ID or not PORT_CLIENT_SECRET:
         print("ERROR: PORT_CLIENT_ID or PORT_CLIENT_SECRET not set!")
@@ -320,7 +573,7 @@ def main():
     # Get access token
     try:
         print("Authenticating with Port API...")
-        access_token = get_port_access_token()
+        set_session_token(get_port_access_token())
         print("Authentication successful\n")
     except Exception as e:
         print(f"Error authenticating: {e}")
@@ -330,24 +583,22 @@ def main():
         print("3. Check that your Port organization has API access enabled")
         sys.exit(1)
     
-    # Fetch all users
+    # Fetch inactive users (filtered by Port)
     try:
-        print("Fetching all users from Port...")
-        all_users = get_all_users(access_token)
-        print(f"Found {len(all_users)} total users\n")
+        print("Fetching inactive users from Port...")
+        inactive_users = get_inactive_users()
+        print(f"Found {len(inactive_users)} users with inactive status\n")
     except Exception as e:
         print(f"Error fetching users: {e}")
         sys.exit(1)
     
-    # Filter inactive users
-    inactive_users = [user for user in all_users if is_inactive(user)]
-    print(f"Found {len(inactive_users)} users with inactive status\n")
-    
-    # Identify users with no recent activity
-    users_to_delete = []
-    for user in inactive_users:
-        if not has_recent_activity(user, DAYS_THRESHOLD):
-            users_to_delete.append(user)
+    # Identify users with no recent activity. is_inactive is re-checked so an
+    # unexpected search result can never cause an active user to be deleted.
+    threshold_date = datetime.now() - timedelta(days=DAYS_THRESHOLD)
+    users_to_delete = [
+        user for user in inactive_users
+        if is_inactive(user) and not has_recent_activity(user, threshold_date)
+    ]
     
     print(f"Found {len(users_to_delete)} inactive users with no activity in the last {DAYS_THRESHOLD} days\n")
     
@@ -355,48 +606,93 @@ def main():
         print("No users to delete. Exiting.")
         return
     
-    # Create backup directory
-    os.makedirs(BACKUP_DIR, exist_ok=True)
+    # Open the backup archive before deleting anything, so every user can be
+    # backed up before they are deleted. The time in the name and
+    # exclusive-create mode ensure an earlier run's archive is never overwritten.
+    timestamp = datetime.now().strftime('%m-%d-%Y_%H-%M-%S')
+    zip_filename = f"{timestamp}_deleted_users.zip"
+    try:
+        zipf = zipfile.ZipFile(zip_filename, 'x', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL)
+    except Exception as e:
+        print(f"Error creating zip archive: {e}")
+        sys.exit(1)
     
-    # Process each user: backup and delete
     removed_users = []
     failed_deletions = []
-    
-    for user in users_to_delete:
+    # Identifiers recorded in the archive manifest
+    deleted_identifiers = []
+    not_deleted_identifiers = []
+    
+    def record_result(user: Dict, result) -> None:
+        """
+        Record the outcome of deleting a user.
+        """
         user_identifier = user.get('identifier', 'unknown')
         user_title = user.get('title', user_identifier)
         
-        try:
-            # Backup user
-            backup_file = backup_user(user, BACKUP_DIR)
-            print(f"Backed up user: {user_title} ({user_identifier})")
-            
-            # Delete user
-            if delete_user(access_token, user_identifier):
-                removed_users.append(user_title)
-                print(f"Deleted user: {user_title} ({user_identifier})")
-            else:
-                failed_deletions.append(user_title)
-                # Remove backup file if deletion failed
-                if os.path.exists(backup_file):
-                    os.remove(backup_file)
-                print(f"Failed to delete user: {user_title} ({user_identifier})")
-        except Exception as e:
-            print(f"Error processing user {user_title} ({user_identifier}): {e}")
+        if result is True:
+            removed_users.append(user_title)
+            deleted_identifiers.append(user_identifier)
+            logger.info(f"Deleted user: {user_title} ({user_identifier})")
+        else:
+            if isinstance(result, Exception):
+                logger.error(f"Error processing user {user_title} ({user_identifier}): {result}")
             failed_deletions.append(user_title)
-    
-    # Create zip archive
-    if removed_users:
-        timestamp = datetime.now().strftime('%m-%d-%Y')
-        zip_filename = f"{timestamp}_deleted_users.zip"
-        
+            not_deleted_identifiers.append(user_identifier)
+            logger.error(f"Failed to delete user: {user_title} ({user_identifier})")
+    
+    # Process users one chunk at a time: back up every user in the chunk, then
+    # delete only the users whose backup was written. The archive is always
+    # closed, even if a later chunk raises or the run is interrupted.
+    print(f"Deleting {len(users_to_delete)} user(s) in chunks of up to {BULK_DELETE_CHUNK_SIZE}...")
+    completed = False
+    try:
+        for chunk in chunked(users_to_delete, BULK_DELETE_CHUNK_SIZE):
+            backed_up_users = []
+            for user in chunk:
+                try:
+                    add_user_to_archive(zipf, user)
+                    backed_up_users.append(user)
+                except Exception as e:
+                    # Never delete a user without a backup
+                    record_result(user, e)
+            
+            if not backed_up_users:
+                continue
+            
+            results = delete_users_bulk([user.get('identifier', 'unknown') for user in backed_up_users])
+            if results is None:
+                results = [False] * len(backed_up_users)
+            
+            # Record confirmed deletions before the fallback runs, so an interrupt
+            # during the fallback can't lose them
+            retry_users = []
+            for user, deleted in zip(backed_up_users, results):
+                if deleted:
+                    record_result(user, True)
+                else:
+                    retry_users.append(user)
+            
+            # Fall back to individual concurrent deletes for users the bulk request didn't delete
+            if retry_users:
+                print(f"Deleting {len(retry_users)} user(s) individually with up to {DELETE_CONCURRENCY} concurrent requests...")
+                retry_results = asyncio.run(delete_users_concurrently(
+                    [user.get('identifier', 'unknown') for user in retry_users]
+                ))
+                for user, result in zip(retry_users, retry_results):
+                    record_result(user, result)
+        completed = True
+    finally:
         try:
-            create_zip_archive(BACKUP_DIR, zip_filename)
+            add_manifest_to_archive(zipf, deleted_identifiers, not_deleted_identifiers)
         except Exception as e:
-            print(f"Error creating zip archive: {e}")
-    
-    # Clean up backup directory
-    cleanup_backup_dir(BACKUP_DIR)
+            logger.error(f"Error writing archive manifest: {e}")
+        zipf.close()
+        if completed and not removed_users:
+            # Nobody was deleted, so this run's own archive holds no backup anyone needs
+            os.remove(zip_filename)
+        else:
+            print(f"\nBackup archive created: {zip_filename}")
     
     # Output results
     print("\n" + "="*60)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Tests for parsing Port bulk delete responses.
+Run with: python -m unittest test_delete_inactive_users
+"""
+
+import unittest
+
+from delete_inactive_users import get_bulk_delete_failures
+
+IDENTIFIERS = ['a', 'b', 'c']
+
+
+class GetBulkDeleteFailuresTest(unittest.TestCase):
+    def test_ok_response_without_errors_confirms_every_user(self):
+        self.assertEqual(get_bulk_delete_failures({'ok': True}, IDENTIFIERS), set())
+        self.assertEqual(get_bulk_delete_failures({'ok': True, 'errors': []}, IDENTIFIERS), set())
+
+    def test_errors_matched_by_identifier(self):
+        data = {'ok': True, 'errors': [{'identifier': 'b', 'message': 'not found'}, 'c']}
+        self.assertEqual(get_bulk_delete_failures(data, IDENTIFIERS), {'b', 'c'})
+
+    def test_errors_matched_by_index(self):
+        data = {'ok': True, 'errors': [{'index': 0}, {'index': 2}]}
+        self.assertEqual(get_bulk_delete_failures(data, IDENTIFIERS), {'a', 'c'})
+
+    def test_unmatched_error_fails_closed(self):
+        for errors in (
+            [{'message': 'something went wrong'}],
+            [{'index': '1'}],
+            [{'index': 3}],
+            [{'index': True}],
+            [{'identifier': 'unknown'}],
+            ['unknown'],
+            {'identifier': 'a'},
+        ):
+            with self.subTest(errors=errors):
+                self.assertIsNone(get_bulk_delete_failures({'ok': True, 'errors': errors}, IDENTIFIERS))
+
+    def test_unknown_response_shape_fails_closed(self):
+        for data in (
+            None,
+            [],
+            '',
+            {},
+            {'ok': False},
+            {'errors': [{'index': 1}]},
+            {'ok': True, 'failedEntities': ['b']},
+        ):
+            with self.subTest(data=data):
+                self.assertIsNone(get_bulk_delete_failures(data, IDENTIFIERS))
+
+
+if __name__ == '__main__':
+    unittest.main()